@@ -3,10 +3,19 @@ from __future__ import annotations
 import sqlite3
 from dataclasses import dataclass
 from datetime import datetime, date
+from itertools import groupby
+from operator import itemgetter
 from typing import Iterable, Optional, Sequence
 
 DB_PATH = "elnajah.db"
 
+# Conservative cap on "?" parameters per statement: 999 was SQLite's limit
+# before 3.32, so staying under it is safe on old builds too
+MAX_SQL_PARAMS = 999
+
+# Bump whenever init_db() gains new tables or indexes
+SCHEMA_VERSION = 2
+
 
 # ---------------------------------------------------------------------------
 # Exceptions
@@ -28,23 +37,71 @@ class AlreadyExistsError(DBError):
 # Low-level helpers
 # ---------------------------------------------------------------------------
 
-def _get_conn(row_factory: bool = False) -> sqlite3.Connection:
+# Database files already switched to WAL by this process
+_wal_enabled_paths: set[str] = set()
+
+
+def _get_conn() -> sqlite3.Connection:
     """
     Return a new sqlite3 connection with foreign keys enabled.
 
-    If row_factory is True we use sqlite3.Row so columns can be accessed by name.
+    Rows are sqlite3.Row, so columns can be accessed by name or by index.
     """
     conn = sqlite3.connect(DB_PATH)
-    if row_factory:
-        conn.row_factory = sqlite3.Row
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers run while a write is in progress. journal_mode is
+    # stored in the database file, so it only needs setting once per file.
+    if DB_PATH not in _wal_enabled_paths:
+        conn.execute("PRAGMA journal_mode = WAL")
+        _wal_enabled_paths.add(DB_PATH)
+    # The rest are per-connection settings; with WAL, synchronous=NORMAL is
+    # still crash-safe and avoids an fsync per commit
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
     # Make sure ON DELETE CASCADE etc. actually work
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
 
+def _values_placeholders(n_rows: int, n_cols: int) -> str:
+    """
+    Return "(?, ?), (?, ?), ..." for a multi-row INSERT ... VALUES clause.
+    """
+    row = "(" + ", ".join("?" * n_cols) + ")"
+    return ", ".join([row] * n_rows)
+
+
+def _insert_rows(
+    c: sqlite3.Cursor,
+    prefix: str,
+    rows: Sequence[tuple],
+    n_cols: int,
+    suffix: str = "",
+) -> None:
+    """
+    Run "<prefix> VALUES ... <suffix>" for all rows.
+
+    Batches that fit under MAX_SQL_PARAMS go out as one multi-row statement
+    (one prepare and one step instead of a bind per row); larger ones fall
+    back to executemany.
+    """
+    if not rows:
+        return
+    if len(rows) * n_cols <= MAX_SQL_PARAMS:
+        c.execute(
+            f"{prefix} VALUES {_values_placeholders(len(rows), n_cols)} {suffix}",
+            [v for row in rows for v in row],
+        )
+    else:
+        c.executemany(
+            f"{prefix} VALUES {_values_placeholders(1, n_cols)} {suffix}",
+            rows,
+        )
+
+
 def _today_str() -> str:
     """Return today's date as YYYY-MM-DD."""
-    return date.today().strftime("%Y-%m-%d")
+    return date.today().isoformat()
 
 
 # ---------------------------------------------------------------------------
@@ -56,34 +113,37 @@ def init_db() -> None:
     Create all tables if they do not exist.
 
     Call this once when your program starts (before using any other function).
+
+    The schema version is stored in PRAGMA user_version, so databases that are
+    already up to date skip the CREATE statements entirely.
     """
     conn = _get_conn()
     c = conn.cursor()
 
-    # Students table
-    c.execute(
-        """
+    c.execute("PRAGMA user_version")
+    if c.fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        return
+
+    # All DDL goes out as one script inside a single transaction
+    c.executescript(
+        f"""
+        BEGIN;
+
+        -- Students table
         CREATE TABLE IF NOT EXISTS students (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             join_date TEXT NOT NULL DEFAULT (date('now'))
-        )
-        """
-    )
+        );
 
-    # Groups table
-    c.execute(
-        """
+        -- Groups table
         CREATE TABLE IF NOT EXISTS groups (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL UNIQUE
-        )
-        """
-    )
+        );
 
-    # Junction: which student belongs to which group(s)
-    c.execute(
-        """
+        -- Junction: which student belongs to which group(s)
         CREATE TABLE IF NOT EXISTS student_group (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             student_id INTEGER NOT NULL,
@@ -91,13 +151,9 @@ def init_db() -> None:
             UNIQUE(student_id, group_id),
             FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE,
             FOREIGN KEY(group_id) REFERENCES groups(id) ON DELETE CASCADE
-        )
-        """
-    )
+        );
 
-    # Payments: one row per (student, year, month)
-    c.execute(
-        """
+        -- Payments: one row per (student, year, month)
         CREATE TABLE IF NOT EXISTS payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             student_id INTEGER NOT NULL,
@@ -107,11 +163,20 @@ def init_db() -> None:
             payment_date TEXT NOT NULL,  -- store as YYYY-MM-DD
             UNIQUE(student_id, year, month),  -- only one payment record per student per month
             FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
-        )
+        );
+
+        -- student_group is UNIQUE on (student_id, group_id); lookups by group
+        -- (group filter, group lists, counts per group) need the reverse order
+        CREATE INDEX IF NOT EXISTS idx_student_group_group
+            ON student_group(group_id, student_id);
+
+        ANALYZE;
+
+        PRAGMA user_version = {SCHEMA_VERSION};
+
+        COMMIT;
         """
     )
-
-    conn.commit()
     conn.close()
 
 
@@ -246,7 +311,7 @@ def get_student(student_id: int) -> Student:
 
     Raises NotFoundError if not found.
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -271,7 +336,7 @@ def get_all_students(order_by: str = "name") -> list[Student]:
     if order_by not in allowed:
         raise ValueError(f"order_by must be one of {allowed}")
 
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -303,9 +368,13 @@ def delete_student(student_id: int, snapshot_for_undo: bool = False) -> Optional
 
     Raises NotFoundError if the student does not exist.
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
+        # Take the write lock up front so the snapshot and the deletes see
+        # the same rows
+        c.execute("BEGIN IMMEDIATE")
+
         # basic student row
         c.execute(
             "SELECT id, name, join_date FROM students WHERE id = ?",
@@ -391,6 +460,9 @@ def restore_student_snapshot(snapshot: dict) -> None:
     conn = _get_conn()
     c = conn.cursor()
     try:
+        # One write transaction: a failure part-way leaves nothing behind
+        c.execute("BEGIN IMMEDIATE")
+
         # check ID availability
         c.execute("SELECT 1 FROM students WHERE id = ?", (sid,))
         if c.fetchone():
@@ -415,14 +487,15 @@ def restore_student_snapshot(snapshot: dict) -> None:
                 )
 
         # restore payments
-        for p in payments:
-            c.execute(
-                """
-                INSERT INTO payments (student_id, year, month, paid, payment_date)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (sid, p["year"], p["month"], p["paid"], p["payment_date"]),
-            )
+        _insert_rows(
+            c,
+            "INSERT INTO payments (student_id, year, month, paid, payment_date)",
+            [
+                (sid, p["year"], p["month"], p["paid"], p["payment_date"])
+                for p in payments
+            ],
+            5,
+        )
 
         conn.commit()
     finally:
@@ -507,6 +580,9 @@ def set_student_groups(student_id: int, group_names: Sequence[str]) -> None:
     conn = _get_conn()
     c = conn.cursor()
     try:
+        # One write transaction for the clear + relink
+        c.execute("BEGIN IMMEDIATE")
+
         # ensure student exists
         c.execute("SELECT 1 FROM students WHERE id = ?", (student_id,))
         if not c.fetchone():
@@ -555,11 +631,48 @@ def get_student_groups(student_id: int) -> list[str]:
         conn.close()
 
 
+def remove_group_where_only_group(group_name: str) -> int:
+    """
+    Unlink the group from every student for whom it is their ONLY group.
+
+    Students who belong to several groups are not changed. This is a single
+    DELETE rather than a per-student read/replace.
+
+    Returns how many students were changed (0 if the group does not exist).
+    """
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT id FROM groups WHERE name = ?", (group_name,))
+        row = c.fetchone()
+        if not row:
+            return 0
+
+        c.execute(
+            """
+            DELETE FROM student_group
+            WHERE group_id = ?
+              AND student_id IN (
+                    SELECT student_id
+                    FROM student_group
+                    GROUP BY student_id
+                    HAVING COUNT(*) = 1
+              )
+            """,
+            (row["id"],),
+        )
+        changed = c.rowcount
+        conn.commit()
+        return changed
+    finally:
+        conn.close()
+
+
 def get_group_students(group_name: str) -> list[Student]:
     """
     Return all students in the given group (by name), ordered by name.
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute("SELECT id FROM groups WHERE name = ?", (group_name,))
@@ -643,44 +756,53 @@ def upsert_payments_bulk(student_id: int, items: Iterable[dict]) -> None:
     items: iterable of dicts with keys:
         year, month, paid ('paid'|'unpaid'), payment_date ('' or 'YYYY-MM-DD')
     """
-    conn = _get_conn()
-    c = conn.cursor()
+    today = _today_str()
     rows = []
     for it in items:
         paid = it["paid"]
         if paid not in ("paid", "unpaid"):
             raise DBError("paid must be 'paid' or 'unpaid'.")
-        payment_date = it.get("payment_date") or _today_str()
+        payment_date = it.get("payment_date") or today
         rows.append(
             (student_id, it["year"], it["month"], paid, payment_date)
         )
 
+    if not rows:
+        return
+
+    conn = _get_conn()
+    c = conn.cursor()
     try:
-        c.executemany(
-            """
-            INSERT INTO payments (student_id, year, month, paid, payment_date)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(student_id, year, month)
-            DO UPDATE SET paid = excluded.paid,
-                          payment_date = excluded.payment_date
-            """,
-            rows,
-        )
-    except sqlite3.OperationalError:
-        c.executemany(
-            """
-            REPLACE INTO payments (student_id, year, month, paid, payment_date)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            rows,
-        )
-    conn.commit()
-    conn.close()
+        # One explicit write transaction (and one sync) for the whole batch
+        c.execute("BEGIN IMMEDIATE")
+
+        try:
+            _insert_rows(
+                c,
+                "INSERT INTO payments (student_id, year, month, paid, payment_date)",
+                rows,
+                5,
+                suffix="""
+                ON CONFLICT(student_id, year, month)
+                DO UPDATE SET paid = excluded.paid,
+                              payment_date = excluded.payment_date
+                """,
+            )
+        except sqlite3.OperationalError:
+            _insert_rows(
+                c,
+                "REPLACE INTO payments (student_id, year, month, paid, payment_date)",
+                rows,
+                5,
+            )
+        conn.commit()
+    finally:
+        conn.close()
 
 
 def get_payment(student_id: int, year: int, month: int) -> Optional[Payment]:
     """Return a single Payment or None."""
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -708,7 +830,7 @@ def get_payment(student_id: int, year: int, month: int) -> Optional[Payment]:
 
 def get_payments_for_student(student_id: int) -> list[Payment]:
     """Return all payments for a student sorted by year, month."""
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -735,6 +857,11 @@ def get_payments_for_student(student_id: int) -> list[Payment]:
         conn.close()
 
 
+def _academic_year_bounds(start_year: int) -> tuple[int, int]:
+    """(year * 100 + month) bounds for Aug of start_year .. Jul of the next year."""
+    return (start_year * 100 + 8, (start_year + 1) * 100 + 7)
+
+
 def get_payments_for_student_academic_year(
     student_id: int, academic_start_year: int
 ) -> list[Payment]:
@@ -748,7 +875,7 @@ def get_payments_for_student_academic_year(
     start_year = academic_start_year
     end_year = academic_start_year + 1
 
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -756,13 +883,11 @@ def get_payments_for_student_academic_year(
             SELECT id, student_id, year, month, paid, payment_date
             FROM payments
             WHERE student_id = ?
-              AND (
-                    (year = ? AND month BETWEEN 8 AND 12)
-                 OR (year = ? AND month BETWEEN 1 AND 7)
-              )
+              AND year BETWEEN ? AND ?
+              AND (year * 100 + month) BETWEEN ? AND ?
             ORDER BY year, month
             """,
-            (student_id, start_year, end_year),
+            (student_id, start_year, end_year) + _academic_year_bounds(start_year),
         )
         return [
             Payment(
@@ -779,11 +904,121 @@ def get_payments_for_student_academic_year(
         conn.close()
 
 
+def get_payment_history_for_academic_year(
+    academic_start_year: int,
+    group_name: Optional[str] = None,
+) -> list[dict]:
+    """
+    Return everything the payments history view needs for one academic year,
+    using a single connection (students, their groups, and their payments).
+
+    Each dict:
+        {
+            "student": Student,
+            "groups": ["G1", "G2", ...],
+            "payments": {(year, month): Payment, ...},
+        }
+
+    If group_name is provided, only students in that group are returned.
+    Students are ordered by name, as in get_group_students()/get_all_students().
+    """
+    start_year = academic_start_year
+    end_year = academic_start_year + 1
+
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        if group_name:
+            student_filter = """
+                WHERE s.id IN (
+                    SELECT sg.student_id
+                    FROM student_group sg
+                    JOIN groups g ON g.id = sg.group_id
+                    WHERE g.name = ?
+                )
+            """
+            filter_params: tuple = (group_name,)
+            order_sql = "ORDER BY s.name"
+        else:
+            student_filter = ""
+            filter_params = ()
+            order_sql = "ORDER BY s.name COLLATE NOCASE"
+
+        c.execute(
+            f"""
+            SELECT s.id, s.name, s.join_date
+            FROM students s
+            {student_filter}
+            {order_sql}
+            """,
+            filter_params,
+        )
+        students = [
+            Student(id=r["id"], name=r["name"], join_date=r["join_date"])
+            for r in c.fetchall()
+        ]
+
+        c.execute(
+            f"""
+            SELECT sg.student_id, g.name
+            FROM student_group sg
+            JOIN groups g ON g.id = sg.group_id
+            WHERE sg.student_id IN (SELECT s.id FROM students s {student_filter})
+            ORDER BY sg.student_id, g.name
+            """,
+            filter_params,
+        )
+        groups_by_student = {
+            sid: [r["name"] for r in rows]
+            for sid, rows in groupby(c.fetchall(), key=itemgetter("student_id"))
+        }
+
+        c.execute(
+            f"""
+            SELECT id, student_id, year, month, paid, payment_date
+            FROM payments
+            WHERE student_id IN (SELECT s.id FROM students s {student_filter})
+              AND year BETWEEN ? AND ?
+              AND (year * 100 + month) BETWEEN ? AND ?
+            ORDER BY student_id
+            """,
+            filter_params + (start_year, end_year) + _academic_year_bounds(start_year),
+        )
+        # Rows come back clustered by student (the UNIQUE(student_id, year, month)
+        # index gives that order for free), so each student is built in one run
+        payments_by_student = {
+            sid: {
+                (r["year"], r["month"]): Payment(
+                    id=r["id"],
+                    student_id=r["student_id"],
+                    year=r["year"],
+                    month=r["month"],
+                    paid=r["paid"],
+                    payment_date=r["payment_date"],
+                )
+                for r in rows
+            }
+            for sid, rows in groupby(c.fetchall(), key=itemgetter("student_id"))
+        }
+
+        return [
+            {
+                "student": stu,
+                "groups": groups_by_student.get(stu.id, []),
+                "payments": payments_by_student.get(stu.id, {}),
+            }
+            for stu in students
+        ]
+    finally:
+        conn.close()
+
+
 def get_students_with_payment_for_month(
     year: int,
     month: int,
     search_text: str = "",
     search_type: str = "name",
+    group_name: Optional[str] = None,
 ) -> list[dict]:
     """
     Return a list of rows used by the main tree view for a given month.
@@ -798,12 +1033,15 @@ def get_students_with_payment_for_month(
         }
 
     search_type: "id" or "name"
+
+    If group_name is provided, only students in that group are returned (their
+    "groups" value still lists all of their groups).
     """
     search_type = search_type.lower()
     if search_type not in ("id", "name"):
         raise ValueError("search_type must be 'id' or 'name'.")
 
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         base_sql = """
@@ -814,7 +1052,7 @@ def get_students_with_payment_for_month(
                 COALESCE(GROUP_CONCAT(g.name, ', '), '') AS groups,
                 CASE
                     WHEN p.payment_date IS NOT NULL
-                         AND strftime('%Y-%m', p.payment_date) = strftime('%Y-%m', ?) THEN
+                         AND substr(p.payment_date, 1, 7) = ? THEN
                          CASE
                              WHEN p.paid = 'paid' THEN 'Paid (' || p.payment_date || ')'
                              WHEN p.paid = 'unpaid' THEN 'Unpaid'
@@ -832,16 +1070,34 @@ def get_students_with_payment_for_month(
                AND p.month = ?
         """
 
-        params: list = [f"{year}-{month:02d}-01", year, month]
+        # "YYYY-MM" prefix computed once; payment dates are compared as strings
+        params: list = [f"{year:04d}-{month:02d}", year, month]
+
+        where: list[str] = []
 
         if search_type == "id" and search_text:
-            base_sql += " WHERE s.id = ? GROUP BY s.id"
+            where.append("s.id = ?")
             params.append(int(search_text))
         elif search_text:
-            base_sql += " WHERE s.name LIKE ? GROUP BY s.id"
+            where.append("s.name LIKE ?")
             params.append(f"%{search_text}%")
-        else:
-            base_sql += " GROUP BY s.id"
+
+        if group_name:
+            where.append(
+                """
+                s.id IN (
+                    SELECT sg2.student_id
+                    FROM student_group sg2
+                    JOIN groups g2 ON g2.id = sg2.group_id
+                    WHERE g2.name = ?
+                )
+                """
+            )
+            params.append(group_name)
+
+        if where:
+            base_sql += " WHERE " + " AND ".join(where)
+        base_sql += " GROUP BY s.id"
 
         c.execute(base_sql, tuple(params))
         rows = []
@@ -870,7 +1126,7 @@ def get_unpaid_students_for_month(
 
     If group_name is provided, filters to that group.
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         sql = """
@@ -918,7 +1174,7 @@ def get_groupless_students() -> list[dict]:
 
     Each dict: {"id": int, "name": str}
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -934,6 +1190,50 @@ def get_groupless_students() -> list[dict]:
         conn.close()
 
 
+def get_all_students_with_groups(order_by: str = "name") -> list[dict]:
+    """
+    Return all students together with their group names, using one connection.
+
+    Each dict: {"student": Student, "groups": ["G1", "G2", ...]}
+
+    order_by is the same as for get_all_students(); groups are sorted by name.
+    """
+    allowed = {"name", "id", "join_date"}
+    if order_by not in allowed:
+        raise ValueError(f"order_by must be one of {allowed}")
+
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            f"SELECT id, name, join_date FROM students ORDER BY {order_by} COLLATE NOCASE"
+        )
+        students = [
+            Student(id=r["id"], name=r["name"], join_date=r["join_date"])
+            for r in c.fetchall()
+        ]
+
+        c.execute(
+            """
+            SELECT sg.student_id, g.name
+            FROM student_group sg
+            JOIN groups g ON g.id = sg.group_id
+            ORDER BY sg.student_id, g.name
+            """
+        )
+        groups_by_student = {
+            sid: [r["name"] for r in rows]
+            for sid, rows in groupby(c.fetchall(), key=itemgetter("student_id"))
+        }
+
+        return [
+            {"student": stu, "groups": groups_by_student.get(stu.id, [])}
+            for stu in students
+        ]
+    finally:
+        conn.close()
+
+
 def delete_students_by_ids(student_ids: Sequence[int]) -> None:
     """
     Delete multiple students by ID.
@@ -946,19 +1246,27 @@ def delete_students_by_ids(student_ids: Sequence[int]) -> None:
     conn = _get_conn()
     c = conn.cursor()
     try:
-        placeholders = ",".join("?" for _ in student_ids)
+        c.execute("BEGIN IMMEDIATE")
+
+        # Stage the IDs in a temp table rather than binding one "?" per ID, so
+        # the statements stay fixed and any number of IDs fits under the
+        # SQLite parameter limit
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS _delete_ids (id INTEGER PRIMARY KEY)")
+        c.execute("DELETE FROM _delete_ids")
+        c.executemany(
+            "INSERT OR IGNORE INTO _delete_ids (id) VALUES (?)",
+            [(sid,) for sid in student_ids],
+        )
+
         # delete payments & links explicitly for compatibility
         c.execute(
-            f"DELETE FROM student_group WHERE student_id IN ({placeholders})",
-            tuple(student_ids),
+            "DELETE FROM student_group WHERE student_id IN (SELECT id FROM _delete_ids)"
         )
         c.execute(
-            f"DELETE FROM payments WHERE student_id IN ({placeholders})",
-            tuple(student_ids),
+            "DELETE FROM payments WHERE student_id IN (SELECT id FROM _delete_ids)"
         )
         c.execute(
-            f"DELETE FROM students WHERE id IN ({placeholders})",
-            tuple(student_ids),
+            "DELETE FROM students WHERE id IN (SELECT id FROM _delete_ids)"
         )
         conn.commit()
     finally:
@@ -971,7 +1279,7 @@ def get_student_counts_by_group() -> list[dict]:
 
     Each dict: {"group": str, "count": int}
     """
-    conn = _get_conn(row_factory=True)
+    conn = _get_conn()
     c = conn.cursor()
     try:
         c.execute(
@@ -983,13 +1291,12 @@ def get_student_counts_by_group() -> list[dict]:
             ORDER BY g.name
             """
         )
-        rows = [
-            {"group": r["group_name"], "count": r["count"]}
-            for r in c.fetchall()
-        ]
+        rows = []
+        total = 0
+        for r in c.fetchall():
+            rows.append({"group": r["group_name"], "count": r["count"]})
+            total += r["count"]
 
-        # total
-        total = sum(r["count"] for r in rows)
         rows.append({"group": "TOTAL", "count": total})
         return rows
     finally:
@@ -64,6 +64,12 @@ MONTHS = [
 _last_deleted_snapshot = None
 _last_deleted_id = None
 
+# (year, month, group) the main tree was last loaded with
+_last_filter = None
+
+# Values last pushed into the group filter dropdown
+_group_menu_values = None
+
 
 # ---------------------------------------------------------------------------
 # Main window setup
@@ -203,12 +209,16 @@ def refresh_group_filter():
     """
     Reload the list of groups for the filter dropdown.
     """
+    global _group_menu_values
     groups = get_all_groups()
     values = ["All"] + groups
     current = group_filter_var.get()
     if current not in values:
         group_filter_var.set("All")
-    group_menu.configure(values=values)
+    # Rebuilding the dropdown menu is not free; skip it when nothing changed
+    if values != _group_menu_values:
+        group_menu.configure(values=values)
+        _group_menu_values = values
 
 
 def _current_year_month():
@@ -230,13 +240,17 @@ def _current_year_month():
 def refresh_treeview_all():
     """
     Re-populate the main tree using filters + search.
+
+    Rows are keyed by student ID: rows that are still present are updated in
+    place, so only removed/added students cost a delete/insert.
     """
-    for item in tree.get_children():
-        tree.delete(item)
+    global _last_filter
 
     year, month = _current_year_month()
     search_text = search_var.get().strip()
     search_type = search_type_var.get()
+    filter_group = group_filter_var.get()
+    current_filter = (year_var.get(), month_var.get(), filter_group)
 
     try:
         rows = get_students_with_payment_for_month(
@@ -244,29 +258,43 @@ def refresh_treeview_all():
             month=month,
             search_text=search_text,
             search_type=search_type,
+            group_name=filter_group if filter_group != "All" else None,
         )
     except Exception as e:
+        # Forget the filter so picking the same menu value again retries
+        _last_filter = None
+        tree.delete(*tree.get_children())
         messagebox.showerror("DB Error", f"Could not load students:\n{e}")
         return
+    _last_filter = current_filter
 
-    filter_group = group_filter_var.get()
+    existing = set(tree.get_children())
+    order = []
+    insert = tree.insert  # bound once for the loop
+    update = tree.item
     for row in rows:
-        # Filter by group if not "All"
-        groups = [g.strip() for g in (row.get("groups") or "").split(",") if g.strip()]
-        if filter_group != "All" and filter_group not in groups:
-            continue
-
-        tree.insert(
-            "",
-            "end",
-            values=(
-                row["id"],
-                row["name"],
-                row.get("groups", ""),
-                row.get("join_date", ""),
-                row.get("monthly_payment", ""),
-            ),
+        iid = str(row["id"])
+        values = (
+            row["id"],
+            row["name"],
+            row.get("groups", ""),
+            row.get("join_date", ""),
+            row.get("monthly_payment", ""),
         )
+        if iid in existing:
+            update(iid, values=values)
+        else:
+            insert("", "end", iid=iid, values=values)
+        order.append(iid)
+
+    stale = existing.difference(order)
+    if stale:
+        tree.delete(*stale)
+
+    # Reused rows keep their old position; only reorder when it changed
+    if list(tree.get_children()) != order:
+        for index, iid in enumerate(order):
+            tree.move(iid, "", index)
 
 
 def on_search_pressed(event=None):
@@ -340,7 +368,6 @@ def open_add_student():
     ctk.CTkLabel(group_frame, text="Assign Groups:", anchor="w").grid(row=0, column=0, sticky="w", pady=(0, 4))
 
     scroll = ctk.CTkScrollableFrame(group_frame, width=420, height=180, fg_color="white")
-    scroll.grid(row=1, column=0, sticky="nsew")
 
     group_vars: dict[str, ctk.BooleanVar] = {}
 
@@ -354,6 +381,8 @@ def open_add_student():
             group_vars[name] = var
 
     reload_groups_in_add()
+    # Grid only once the checkboxes exist so Tk lays them out in one pass
+    scroll.grid(row=1, column=0, sticky="nsew")
 
     # Buttons
     btn_frame = ctk.CTkFrame(top, fg_color="transparent")
@@ -789,6 +818,30 @@ def refresh_all():
     refresh_group_filter()
     refresh_treeview_all()
 
+
+# Filter menus go through a short debounce so rapid changes cause one reload
+_pending_refresh = None
+
+
+def schedule_refresh_all(*_):
+    global _pending_refresh
+    if _pending_refresh is not None:
+        ElNajahSchool.after_cancel(_pending_refresh)
+    _pending_refresh = ElNajahSchool.after(250, _run_scheduled_refresh)
+
+
+def _run_scheduled_refresh():
+    global _pending_refresh
+    _pending_refresh = None
+    refresh_all()
+
+
+def on_filter_menu_changed(_value=None):
+    # Option menus fire even when the current value is picked again
+    if (year_var.get(), month_var.get(), group_filter_var.get()) == _last_filter:
+        return
+    schedule_refresh_all()
+
 menu_tools.ElNajahSchool = ElNajahSchool
 menu_tools.refresh_treeview_all = refresh_treeview_all
 menu_tools.get_all_groups = get_all_groups
@@ -800,9 +853,9 @@ payments_log.refresh_all = refresh_all
 
 # Bindings
 search_entry.bind("<Return>", on_search_pressed)
-year_menu.configure(command=lambda _value: refresh_all())
-month_menu.configure(command=lambda _value: refresh_all())
-group_menu.configure(command=lambda _value: refresh_all())
+year_menu.configure(command=on_filter_menu_changed)
+month_menu.configure(command=on_filter_menu_changed)
+group_menu.configure(command=on_filter_menu_changed)
 
 # Initial load
 refresh_all()
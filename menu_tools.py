@@ -1,7 +1,7 @@
 import customtkinter as ctk
 import tkinter as tk
-import shutil
 import os
+import sqlite3
 import time
 import webbrowser
 import urllib.parse
@@ -16,11 +16,13 @@ from DB import (
     DBError,
     NotFoundError,
     get_all_students,
+    get_all_students_with_groups,
     get_all_groups as db_get_all_groups,
     get_student,
     get_student_groups,
     set_student_groups,
     get_group_students,
+    remove_group_where_only_group,
     get_groupless_students,
     delete_students_by_ids,
     get_unpaid_students_for_month,
@@ -28,6 +30,7 @@ from DB import (
     get_payments_for_student_academic_year,
     upsert_payments_bulk,
 )
+from payments_log import months_for_academic_year
 
 # These will be injected from the main file:
 #   menu_tools.ElNajahSchool = ElNajahSchool
@@ -49,7 +52,7 @@ def _root():
 
 def _today_str():
     from datetime import date
-    return date.today().strftime("%Y-%m-%d")
+    return date.today().isoformat()
 
 
 def _ensure_groups_func():
@@ -167,9 +170,13 @@ def merge_duplicate_students():
             master_payments = get_payments_for_student(master.id)
         except DBError:
             master_payments = []
-        master_map = {(p.year, p.month): p for p in master_payments}
+        # (year, month) -> (paid, payment_date), updated as each dup is folded in
+        master_state = {(p.year, p.month): (p.paid, p.payment_date) for p in master_payments}
 
-        # For each duplicate student
+        combined_groups = set(master_groups)
+        merge_items: dict[tuple[int, int], dict] = {}
+
+        # Fold every duplicate into the master in memory, then write once
         for dup in others:
             try:
                 dup_groups = set(get_student_groups(dup.id))
@@ -182,65 +189,65 @@ def merge_duplicate_students():
                 dup_payments = []
 
             # Merge groups
-            combined_groups = master_groups.union(dup_groups)
-            try:
-                set_student_groups(master.id, sorted(combined_groups))
-            except DBError:
-                pass
-            master_groups = combined_groups
+            combined_groups |= dup_groups
 
             # Merge payments:
             #   - If master has no record for (year,month), copy dup's record.
             #   - If both have records:
             #       * if one is 'paid' and the other is 'unpaid', choose 'paid'.
             #       * if both 'paid', choose the one with earlier payment_date.
-            merge_items = []
             for p in dup_payments:
                 mk = (p.year, p.month)
-                mp = master_map.get(mk)
-                if mp is None:
+                current = master_state.get(mk)
+                if current is None:
                     # master has nothing -> copy dup
-                    merge_items.append({
-                        "year": p.year,
-                        "month": p.month,
-                        "paid": p.paid,
-                        "payment_date": p.payment_date,
-                    })
+                    chosen_paid, chosen_date = p.paid, p.payment_date
                 else:
                     # conflict
-                    chosen_paid = mp.paid
-                    chosen_date = mp.payment_date
+                    chosen_paid, chosen_date = current
 
-                    if mp.paid == "paid" and p.paid == "unpaid":
+                    if chosen_paid == "paid" and p.paid == "unpaid":
                         pass  # keep master
-                    elif mp.paid == "unpaid" and p.paid == "paid":
+                    elif chosen_paid == "unpaid" and p.paid == "paid":
                         chosen_paid = "paid"
                         chosen_date = p.payment_date
-                    elif mp.paid == "paid" and p.paid == "paid":
+                    elif chosen_paid == "paid" and p.paid == "paid":
                         # keep the earlier date
-                        if p.payment_date < mp.payment_date:
+                        if p.payment_date < chosen_date:
                             chosen_date = p.payment_date
 
-                    merge_items.append({
-                        "year": p.year,
-                        "month": p.month,
-                        "paid": chosen_paid,
-                        "payment_date": chosen_date,
-                    })
+                master_state[mk] = (chosen_paid, chosen_date)
+                merge_items[mk] = {
+                    "year": p.year,
+                    "month": p.month,
+                    "paid": chosen_paid,
+                    "payment_date": chosen_date,
+                }
 
-            if merge_items:
-                try:
-                    upsert_payments_bulk(master.id, merge_items)
-                except DBError:
-                    pass
+            merged_pairs.append((master.id, dup.id))
 
-            # Delete duplicate student
+        if combined_groups != master_groups:
             try:
-                delete_students_by_ids([dup.id])
+                set_student_groups(master.id, sorted(combined_groups))
             except DBError:
-                continue
+                pass
 
-            merged_pairs.append((master.id, dup.id))
+        if merge_items:
+            try:
+                upsert_payments_bulk(master.id, merge_items.values())
+            except DBError:
+                pass
+
+    # Delete all merged duplicates in one go
+    if merged_pairs:
+        try:
+            delete_students_by_ids([dup_id for _, dup_id in merged_pairs])
+        except DBError as e:
+            messagebox.showerror("DB Error", str(e))
+            # masters were already updated above, so the tree is stale anyway
+            if refresh_treeview_all:
+                refresh_treeview_all()
+            return
 
     if not merged_pairs:
         messagebox.showinfo("No Changes", "No students were merged.")
@@ -306,25 +313,12 @@ def bulk_remove_group_if_only_group():
             return
 
         try:
-            students = get_group_students(group_name)
+            changed = remove_group_where_only_group(group_name)
         except DBError as e:
             messagebox.showerror("DB Error", str(e))
             dlg.destroy()
             return
 
-        changed = 0
-        for stu in students:
-            try:
-                groups_for_stu = get_student_groups(stu.id)
-            except DBError:
-                continue
-            if len(groups_for_stu) == 1 and groups_for_stu[0] == group_name:
-                try:
-                    set_student_groups(stu.id, [])
-                except DBError:
-                    continue
-                changed += 1
-
         messagebox.showinfo(
             "Done",
             f"Removed group '{group_name}' from {changed} student(s) where it was the only group."
@@ -346,6 +340,24 @@ def _db_path():
     return "elnajah.db"
 
 
+def _sqlite_copy(src_path: str, dest_path: str) -> None:
+    """
+    Copy one SQLite database into another using SQLite's backup API.
+
+    The DB runs in WAL mode, so recent commits may still live in the -wal
+    file; a plain file copy of the .db would miss them.
+    """
+    src = sqlite3.connect(src_path)
+    try:
+        dest = sqlite3.connect(dest_path)
+        try:
+            src.backup(dest)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+
+
 def backup_database():
     """
     Create a timestamped backup of elnajah.db in a 'backups' folder.
@@ -361,7 +373,7 @@ def backup_database():
     dest = os.path.join("backups", backup_name)
 
     try:
-        shutil.copy2(db_file, dest)
+        _sqlite_copy(db_file, dest)
     except Exception as e:
         messagebox.showerror("Backup Error", f"Could not back up database:\n{e}")
         return
@@ -398,7 +410,7 @@ def restore_backup():
 
     db_file = _db_path()
     try:
-        shutil.copy2(filename, db_file)
+        _sqlite_copy(filename, db_file)
     except Exception as e:
         messagebox.showerror("Restore Error", f"Could not restore backup:\n{e}")
         return
@@ -488,14 +500,16 @@ def _ask_group(parent=None) -> str | None:
     menu = ctk.CTkOptionMenu(win, variable=group_var, values=groups, width=220)
     menu.pack(pady=6)
 
-    chosen = {"value": None}
+    chosen: str | None = None
 
     def on_ok():
-        chosen["value"] = group_var.get()
+        nonlocal chosen
+        chosen = group_var.get()
         win.destroy()
 
     def on_cancel():
-        chosen["value"] = None
+        nonlocal chosen
+        chosen = None
         win.destroy()
 
     btn_frame = ctk.CTkFrame(win, fg_color="transparent")
@@ -504,7 +518,7 @@ def _ask_group(parent=None) -> str | None:
     ctk.CTkButton(btn_frame, text="Cancel", command=on_cancel).pack(side="left", padx=4)
 
     win.wait_window()
-    return chosen["value"]
+    return chosen
 
 
 def open_group_selector_and_export():
@@ -578,7 +592,7 @@ def export_all_students_excel():
     Export all students (ID, Name, Join Date, Groups) to an Excel file.
     """
     try:
-        students = get_all_students(order_by="name")
+        students = get_all_students_with_groups(order_by="name")
     except DBError as e:
         messagebox.showerror("DB Error", f"Could not load students:\n{e}")
         return
@@ -593,12 +607,9 @@ def export_all_students_excel():
 
     ws.append(["ID", "Name", "Join Date", "Groups"])
 
-    for stu in students:
-        try:
-            groups_list = get_student_groups(stu.id)
-        except DBError:
-            groups_list = []
-        groups_str = ", ".join(groups_list)
+    for entry in students:
+        stu = entry["student"]
+        groups_str = ", ".join(entry["groups"])
         ws.append([stu.id, stu.name, stu.join_date, groups_str])
 
     os.makedirs("exports", exist_ok=True)
@@ -758,25 +769,6 @@ def export_student_count_pdf():
 # Export: single student's payment history (academic year) to PDF
 # ---------------------------------------------------------------------------
 
-def _months_for_academic_year(start_year: int):
-    """
-    Same logic as in paymants_log: returns list of (year, month, label).
-    Academic year: Aug(start_year)..Dec(start_year), Jan(start_year+1)..Jul(start_year+1).
-    """
-    labels = ["Aug", "Sep", "Oct", "Nov", "Dec",
-              "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul"]
-    months = []
-    for idx, lab in enumerate(labels):
-        if idx < 5:
-            y = start_year
-            m = 8 + idx
-        else:
-            y = start_year + 1
-            m = idx - 4
-        months.append((y, m, lab))
-    return months
-
-
 def export_student_payment_history_pdf():
     """
     Prompt for Student ID and academic start year (e.g. 2024 for 2024–2025),
@@ -822,7 +814,7 @@ def export_student_payment_history_pdf():
         return
 
     pay_map = {(p.year, p.month): p for p in payments}
-    months_spec = _months_for_academic_year(start_year)
+    months_spec = months_for_academic_year(start_year)
     groups_str = ", ".join(groups_list)
 
     os.makedirs("exports", exist_ok=True)
@@ -16,8 +16,12 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 
 from datetime import datetime, date
+from functools import lru_cache
 import os
+import re
 import json
+import queue
+import threading
 
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.pdfgen import canvas
@@ -28,9 +32,8 @@ from DB import (
     get_student,
     get_student_groups,
     get_all_groups,
-    get_all_students,
-    get_group_students,
     get_payments_for_student_academic_year,
+    get_payment_history_for_academic_year,
     upsert_payments_bulk,
 )
 
@@ -48,16 +51,39 @@ MONTH_COLS = [
     "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul"
 ]
 
+# History cell text per payment status, and the one-letter form used in PDFs
+CELL_TEXT = {"paid": "Paid", "unpaid": "Unpaid"}
+PDF_CELL_TEXT = {"Paid": "P", "Unpaid": "U"}
+
+# History rows inserted per event-loop turn when filling the tree
+FILL_CHUNK_SIZE = 200
+
 # Preferences file to remember last selected academic year/group
 PREFS_PATH = os.path.join(os.path.dirname(__file__), "payments_history_prefs.json")
 
+# Strict YYYY-MM-DD matcher used to validate payment dates
+_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+
 
 # ---------------------------------------------------------------------------
 # Utility helpers
 # ---------------------------------------------------------------------------
 
 def _today_str() -> str:
-    return date.today().strftime("%Y-%m-%d")
+    return date.today().isoformat()
+
+
+def _parse_ymd(ds: str) -> date:
+    """
+    Parse a 'YYYY-MM-DD' string without going through strptime.
+
+    Raises ValueError if the string is not a valid date in that format.
+    """
+    m = _DATE_RE.fullmatch(ds)
+    if m is None:
+        raise ValueError(f"Invalid date format: {ds}")
+    y, mo, d = m.groups()
+    return date(int(y), int(mo), int(d))
 
 
 def guess_current_academic_start_year() -> int:
@@ -96,47 +122,56 @@ def get_academic_year_labels() -> list[str]:
     return [make_academic_label(y) for y in years]
 
 
-def months_for_academic_year(start_year: int) -> list[tuple[int, int, str]]:
+@lru_cache(maxsize=32)
+def months_for_academic_year(start_year: int) -> tuple[tuple[int, int, str], ...]:
     """
-    For an academic year starting in 'start_year', return a list of:
+    For an academic year starting in 'start_year', return a tuple of:
         (year, month, label)
     in academic order: Aug..Dec (start_year), Jan..Jul (start_year+1).
 
-    Label corresponds to entries in MONTH_COLS.
+    Label corresponds to entries in MONTH_COLS. Results are cached per year,
+    which is why an immutable tuple is returned.
     """
-    months: list[tuple[int, int, str]] = []
-    for idx, label in enumerate(MONTH_COLS):
-        if idx < 5:  # Aug..Dec
-            y = start_year
-            m = 8 + idx
-        else:        # Jan..Jul
-            y = start_year + 1
-            m = idx - 4
-        months.append((y, m, label))
-    return months
+    # Month index counted from January of start_year: Aug = 7, ..., Jul = 18
+    return tuple(
+        (start_year + (7 + idx) // 12, (7 + idx) % 12 + 1, label)
+        for idx, label in enumerate(MONTH_COLS)
+    )
 
 
 # ---------------------------------------------------------------------------
 # Preferences (last used academic year & group)
 # ---------------------------------------------------------------------------
 
+# Last prefs read from / written to PREFS_PATH, so closing the window without
+# changing anything doesn't rewrite the file
+_last_prefs: dict | None = None
+
+
 def load_prefs() -> dict:
+    global _last_prefs
     try:
         with open(PREFS_PATH, "r", encoding="utf-8") as f:
             data = json.load(f)
-            return data if isinstance(data, dict) else {}
+            data = data if isinstance(data, dict) else {}
     except Exception:
         return {}
+    _last_prefs = dict(data)
+    return data
 
 
 def save_prefs(academic_label: str, group_name: str) -> None:
+    global _last_prefs
     data = {
         "academic_label": academic_label,
         "group_name": group_name,
     }
+    if data == _last_prefs:
+        return
     try:
         with open(PREFS_PATH, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
+        _last_prefs = data
     except Exception:
         # preferences are nice-to-have; ignore errors
         pass
@@ -157,35 +192,24 @@ def load_history_rows(academic_start_year: int, group_name: str | None) -> list[
             "cells": [text_for_Aug, ..., text_for_Jul]
         }
     """
-    if group_name and group_name != "All":
-        students = get_group_students(group_name)
-    else:
-        students = get_all_students(order_by="name")
+    history = get_payment_history_for_academic_year(
+        academic_start_year,
+        group_name if group_name and group_name != "All" else None,
+    )
 
     months_spec = months_for_academic_year(academic_start_year)
     rows: list[dict] = []
 
-    for stu in students:
-        try:
-            groups_list = get_student_groups(stu.id)
-            groups_str = ", ".join(groups_list)
-        except DBError:
-            groups_str = ""
-
-        payments = get_payments_for_student_academic_year(stu.id, academic_start_year)
-        pay_map = {(p.year, p.month): p for p in payments}
+    for entry in history:
+        stu = entry["student"]
+        groups_str = ", ".join(entry["groups"])
+        pay_map = entry["payments"]
 
         cells: list[str] = []
         for (py, pm, _label) in months_spec:
             p = pay_map.get((py, pm))
-            if p:
-                if p.paid == "paid":
-                    cell_text = f"Paid"
-                else:
-                    cell_text = "Unpaid"
-            else:
-                cell_text = ""  # no record
-            cells.append(cell_text)
+            # "" means no record
+            cells.append(CELL_TEXT.get(p.paid, "Unpaid") if p else "")
 
         rows.append({
             "student": stu,
@@ -261,8 +285,8 @@ def open_edit_payment_modal(
     body_frame.grid_rowconfigure(0, weight=1)
     body_frame.grid_columnconfigure(0, weight=1)
 
+    # Gridded only after all rows are built, so Tk lays it out once
     scroll = ctk.CTkScrollableFrame(body_frame, fg_color="white")
-    scroll.grid(row=0, column=0, sticky="nsew")
 
     # Table header
     header_row = ctk.CTkFrame(scroll, fg_color="#E5E7EB")
@@ -284,7 +308,9 @@ def open_edit_payment_modal(
         default_paid = p.paid if p else "unpaid"
         default_date = p.payment_date if p else today_str
 
-        row_frame = ctk.CTkFrame(scroll, fg_color="transparent")
+        # Plain tk containers: these frames are layout only, and tk widgets
+        # skip CustomTkinter's canvas drawing
+        row_frame = tk.Frame(scroll, bg="white")
         row_frame.grid(row=idx, column=0, sticky="ew", pady=2)
         row_frame.grid_columnconfigure(2, weight=1)
 
@@ -294,7 +320,7 @@ def open_edit_payment_modal(
 
         paid_var = tk.StringVar(value=default_paid if default_paid in ("paid", "unpaid") else "unpaid")
 
-        status_frame = ctk.CTkFrame(row_frame, fg_color="transparent")
+        status_frame = tk.Frame(row_frame, bg="white")
         status_frame.grid(row=0, column=1, padx=4, pady=2, sticky="w")
 
         ctk.CTkRadioButton(status_frame, text="Paid", variable=paid_var, value="paid").grid(row=0, column=0, padx=2)
@@ -311,6 +337,8 @@ def open_edit_payment_modal(
             "date_entry": date_entry,
         })
 
+    scroll.grid(row=0, column=0, sticky="nsew")
+
     # Buttons
     btn_frame = ctk.CTkFrame(win, fg_color="transparent")
     btn_frame.pack(fill="x", padx=12, pady=(4, 10))
@@ -322,12 +350,13 @@ def open_edit_payment_modal(
             if paid not in ("paid", "unpaid"):
                 paid = "unpaid"
             ds = st["date_entry"].get().strip() or today_str
-            # simple validation
-            try:
-                datetime.strptime(ds, "%Y-%m-%d")
-            except ValueError:
-                messagebox.showerror("Invalid date", f"Invalid date format: {ds}\nUse YYYY-MM-DD.")
-                return
+            # simple validation (today's date is always valid, skip parsing it)
+            if ds != today_str:
+                try:
+                    _parse_ymd(ds)
+                except ValueError:
+                    messagebox.showerror("Invalid date", f"Invalid date format: {ds}\nUse YYYY-MM-DD.")
+                    return
 
             items.append({
                 "year": st["year"],
@@ -424,13 +453,7 @@ def export_history_pdf(academic_label: str, group_name: str | None) -> None:
         c.drawString(x_positions[2], y, groups_str[:26])
 
         for idx, val in enumerate(cells):
-            if val.startswith("Paid"):
-                txt = "P"
-            elif val == "Unpaid":
-                txt = "U"
-            else:
-                txt = ""
-            c.drawString(x_positions[3 + idx], y, txt)
+            c.drawString(x_positions[3 + idx], y, PDF_CELL_TEXT.get(val, ""))
 
         y -= line_h
 
@@ -539,23 +562,85 @@ def open_history_window(root: ctk.CTk | None = None) -> None:
     bottom_frame = ctk.CTkFrame(win, fg_color="transparent")
     bottom_frame.pack(side="bottom", fill="x", padx=12, pady=(4, 10))
 
-    def refresh_tree():
+    # Shown next to the buttons while a background load is running
+    status_label = ctk.CTkLabel(top_frame, text="", font=("Arial", 12))
+    status_label.grid(row=0, column=5, padx=4, pady=4, sticky="w")
+
+    # Loaded rows per (academic start year, group); cleared when payments change
+    rows_cache: dict[tuple[int, str], list[dict]] = {}
+
+    # DB loads run on a worker thread and post (token, key, rows | error) here.
+    # Only the Tk thread reads the queue; a newer refresh bumps load_token so
+    # results from older loads are dropped.
+    load_queue: queue.Queue = queue.Queue()
+    load_token = 0
+
+    def _fill_tree(rows: list[dict], token: int, start: int = 0):
+        # Insert a chunk, then yield to the event loop for the rest so large
+        # groups don't freeze the window; a newer refresh cancels via the token
+        if token != load_token or not win.winfo_exists():
+            return
+        insert = tree.insert  # bound once for the loop
+        end = start + FILL_CHUNK_SIZE
+        for row in rows[start:end]:
+            stu = row["student"]
+            insert("", "end", values=[stu.id, stu.name, row["groups"]] + row["cells"])
+        if end < len(rows):
+            win.after(1, _fill_tree, rows, token, end)
+
+    def _load_rows_worker(token: int, start_year: int, g_name: str):
+        try:
+            result = load_history_rows(start_year, g_name if g_name != "All" else None)
+        except Exception as e:
+            result = e
+        load_queue.put((token, (start_year, g_name), result))
+
+    def _poll_load(token: int):
+        if token != load_token or not win.winfo_exists():
+            return
+        try:
+            done_token, key, result = load_queue.get_nowait()
+        except queue.Empty:
+            win.after(50, _poll_load, token)
+            return
+        if done_token != token:
+            # stale result from a superseded load; keep waiting for ours
+            win.after(50, _poll_load, token)
+            return
+
+        status_label.configure(text="")
+        if isinstance(result, Exception):
+            messagebox.showerror("DB Error", str(result))
+            return
+        rows_cache[key] = result
+        _fill_tree(result, token)
+
+    def refresh_tree(force: bool = False):
+        nonlocal load_token
+        load_token += 1
+
+        if force:
+            rows_cache.clear()
+
         # Clear
         for item in tree.get_children():
             tree.delete(item)
 
         start_year = parse_academic_label(academic_year_var.get())
         g_name = group_var.get()
-        try:
-            rows = load_history_rows(start_year, g_name if g_name != "All" else None)
-        except DBError as e:
-            messagebox.showerror("DB Error", str(e))
+        rows = rows_cache.get((start_year, g_name))
+        if rows is not None:
+            status_label.configure(text="")
+            _fill_tree(rows, load_token)
             return
 
-        for row in rows:
-            stu = row["student"]
-            vals = [stu.id, stu.name, row["groups"]] + row["cells"]
-            tree.insert("", "end", values=vals)
+        status_label.configure(text="Loading…")
+        threading.Thread(
+            target=_load_rows_worker,
+            args=(load_token, start_year, g_name),
+            daemon=True,
+        ).start()
+        win.after(50, _poll_load, load_token)
 
     def on_edit_selected():
         sel = tree.selection()
@@ -571,7 +656,9 @@ def open_history_window(root: ctk.CTk | None = None) -> None:
             return
 
         start_year = parse_academic_label(academic_year_var.get())
-        open_edit_payment_modal(win, sid, start_year, refresh_callback=refresh_tree)
+        open_edit_payment_modal(
+            win, sid, start_year, refresh_callback=lambda: refresh_tree(force=True)
+        )
 
     def on_double_click(event=None):
         on_edit_selected()
@@ -584,7 +671,7 @@ def open_history_window(root: ctk.CTk | None = None) -> None:
         win.destroy()
 
     # Buttons on top frame
-    ctk.CTkButton(btn_frame, text="Refresh", command=refresh_tree).pack(side="left", padx=2)
+    ctk.CTkButton(btn_frame, text="Refresh", command=lambda: refresh_tree(force=True)).pack(side="left", padx=2)
     ctk.CTkButton(btn_frame, text="Edit Selected", command=on_edit_selected).pack(side="left", padx=2)
     ctk.CTkButton(btn_frame, text="Export PDF", command=on_export).pack(side="left", padx=2)
     ctk.CTkButton(btn_frame, text="Close", command=on_close).pack(side="left", padx=2)